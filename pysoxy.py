@@ -13,23 +13,56 @@ URL_GFW_LIST = "https://cdn.jsdelivr.net/gh/gfwlist/gfwlist/gfwlist.txt"
 
 # Network
 import socket
-import select
-from struct import pack, unpack
+import selectors
+from struct import pack, unpack_from
+import errno
+# WPAD
+import base64
+import http.client
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 # System
+import ctypes
+import os
+import re
 import traceback
-from threading import Thread, activeCount
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from heapq import heappush, heappop
+from itertools import count
+from threading import Thread, Event
 from signal import signal, SIGINT, SIGTERM
-from time import sleep
+from time import monotonic
 import sys
 
 #
 # Configuration
 #
-MAX_THREADS = 200
-BUFSIZE = 2048
+MAX_CONNECTIONS = 200
+# Most clients accepted per wakeup, so a burst can't starve open tunnels
+ACCEPT_BATCH = 64
+# Seconds to stop accepting after running out of fds, unless a connection
+# closes before
+ACCEPT_BACKOFF = 1
+BUFSIZE = 65536
+# Size of the kernel send/receive buffers of every tunnel socket, e.g.
+# 4 << 20. None keeps the system default, which on Linux also keeps
+# receive buffer autotuning
+SOCKET_BUFSIZE = None
 TIMEOUT_SOCKET = 5
+# Number of threads resolving domain names off the event loop
+DNS_WORKERS = os.cpu_count() or 1
+# Resolutions allowed to wait for a free DNS worker, requests beyond this
+# fail right away instead of timing out
+DNS_BACKLOG = 32
+# Resolved domain names are reused for this many seconds, for at most
+# DNS_CACHE_SIZE names
+DNS_CACHE_TTL = 60
+DNS_CACHE_SIZE = 4096
 LOCAL_ADDR = '0.0.0.0'
 LOCAL_PORT = 9050
+# Number of processes accepting on LOCAL_PORT, each running its own event
+# loop. The kernel spreads clients between them with SO_REUSEPORT (Linux)
+WORKERS = 1
 # Parameter to bind a socket to a device, using SO_BINDTODEVICE
 # Only root can set this option
 # If the name is an empty string or None, the interface is chosen when
@@ -59,20 +92,56 @@ ATYP_IPV4 = b'\x01'
 # DOMAINNAME '03'
 ATYP_DOMAINNAME = b'\x03'
 ATYP_IPV6 = b'\x04'
+'''Reply constants'''
+# Method selection: no authentication, or no acceptable method
+_SUBNEG_OK = VER + M_NOAUTH
+_SUBNEG_FAIL = VER + M_NOTAVAILABLE
+# Succeeded, followed by BND.ADDR and BND.PORT
+_REPLY_OK_IPV4 = VER + b'\x00' + b'\x00' + ATYP_IPV4
+_REPLY_OK_IPV6 = VER + b'\x00' + b'\x00' + ATYP_IPV6
+# General SOCKS server failure
+_REPLY_FAIL = VER + b'\x01' + b'\x00' + ATYP_IPV4 + b'\x00' * 6
+'''Connection states'''
+# Waiting for the version identifier/method selection message
+AWAIT_GREETING = 0
+# Waiting for the SOCKS request
+AWAIT_REQUEST = 1
+# Resolving and connecting to the destination
+CONNECTING = 2
+# Relaying data in both directions
+RELAY = 3
+# Flushing pending data before closing
+CLOSING = 4
+# Discarding what the client still sends after the final reply
+LINGERING = 5
+CLOSED = 6
+'''splice(2) constants'''
+SPLICE_F_MOVE = 1
+SPLICE_F_NONBLOCK = 2
+# No SPLICE_F_MORE, TCP would hold back every partial segment waiting for
+# more and add a delay of hundreds of ms to each interactive round trip
+SPLICE_FLAGS = SPLICE_F_MOVE | SPLICE_F_NONBLOCK
+# Bytes moved per splice, the default capacity of a pipe
+SPLICE_LEN = 1 << 16
 
+# Linux can relay data inside the kernel through a pipe with splice(2),
+# elsewhere (iOS) data goes through recv/send
+try:
+    _libc = ctypes.CDLL(None, use_errno=True)
+    _splice = _libc.splice
+    _splice.argtypes = [
+        ctypes.c_int, ctypes.c_void_p, ctypes.c_int, ctypes.c_void_p,
+        ctypes.c_size_t, ctypes.c_uint,
+    ]
+    _splice.restype = ctypes.c_ssize_t
+except (OSError, AttributeError):
+    _splice = None
 
-class ExitStatus:
-    """ Manage exit status """
-    def __init__(self):
-        self.exit = False
+# Written to wake up the loop, an eventfd only accepts an 8 byte counter
+WAKEUP_DATA = (1).to_bytes(8, sys.byteorder)
 
-    def set_status(self, status):
-        """ set exist status """
-        self.exit = status
-
-    def get_status(self):
-        """ get exit status """
-        return self.exit
+# Only Linux has TCP_QUICKACK
+TCP_QUICKACK = getattr(socket, 'TCP_QUICKACK', None)
 
 
 def error(msg="", err=None):
@@ -84,154 +153,586 @@ def error(msg="", err=None):
         traceback.print_exc()
 
 
-def proxy_loop(socket_src, socket_dst):
-    """ Wait for network activity """
-    while not EXIT.get_status():
+def splice(fd_in, fd_out, length):
+    """ Move up to length bytes from fd_in to fd_out without copying """
+    sent = _splice(fd_in, None, fd_out, None, length, SPLICE_FLAGS)
+    if sent < 0:
+        err = ctypes.get_errno()
+        raise OSError(err, os.strerror(err))
+    return sent
+
+
+def set_buffers(sock):
+    """ Apply SOCKET_BUFSIZE to sock, as far as the system allows """
+    if SOCKET_BUFSIZE:
         try:
-            reader, _, _ = select.select([socket_src, socket_dst], [], [], 1)
-        except select.error as err:
-            error("Select failed", err)
-            return
-        if not reader:
-            continue
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, SOCKET_BUFSIZE)
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, SOCKET_BUFSIZE)
+        except socket.error:
+            # iOS refuses sizes above kern.ipc.maxsockbuf with ENOBUFS, the
+            # default buffers still work
+            pass
+
+
+def quickack(sock):
+    """ Ask for immediate ACKs, Linux clears this again after a while """
+    if TCP_QUICKACK:
+        sock.setsockopt(socket.IPPROTO_TCP, TCP_QUICKACK, 1)
+
+
+def set_nodelay(sock):
+    """ Disable Nagle's algorithm and delayed ACKs on sock """
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    quickack(sock)
+
+
+def wakeup():
+    """ Wake up the event loop from a signal handler or another thread """
+    try:
+        os.write(WAKEUP_W, WAKEUP_DATA)
+    except BlockingIOError:
+        # Already full, so a wakeup is pending anyway
+        pass
+
+
+class Connection:
+    """
+        One client tunnel, driven by the event loop through the states
+        AWAIT_GREETING, AWAIT_REQUEST, CONNECTING, RELAY and CLOSING
+    """
+
+    def __init__(self, wrapper):
+        self.wrapper = wrapper
+        self.socket_dst = None
+        self.state = AWAIT_GREETING
+        # Data waiting to be written, keyed by the socket it is written to
+        self.pending = {wrapper: bytearray()}
+        # Sockets which reached end of stream while relaying, and sockets
+        # whose writing side was shut down in turn
+        self.eof = set()
+        self.shut = set()
+        # The part of the client's current handshake message read so far
+        self.message = bytearray()
+        # Pipes (read end, write end) used to splice data into a socket,
+        # keyed by that socket, and the number of bytes left in each. A
+        # pipe is only created once data flows that way
+        self.splicing = _splice is not None
+        self.pipes = {}
+        self.in_pipe = {}
+        wrapper.setblocking(False)
+        set_nodelay(wrapper)
+        CONNECTIONS.add(self)
+        self.update()
+
+    def backlog(self, sock):
+        """ Number of bytes waiting to be written to sock """
+        return len(self.pending[sock]) + self.in_pipe.get(sock, 0)
+
+    def peer(self, sock):
+        """ Return the other end of the tunnel """
+        return self.socket_dst if sock is self.wrapper else self.wrapper
+
+    def handle(self, sock, mask):
+        """ Called by the event loop when sock is ready """
         try:
-            for sock in reader:
-                data = sock.recv(BUFSIZE)
-                if not data:
+            if mask & selectors.EVENT_WRITE:
+                if self.state == CONNECTING and sock is self.socket_dst:
+                    self.connected()
+                elif not self.flush(sock):
                     return
-                if sock is socket_dst:
-                    socket_src.send(data)
-                else:
-                    socket_dst.send(data)
+            if mask & selectors.EVENT_READ:
+                if self.state == AWAIT_GREETING:
+                    self.subnegotiation()
+                elif self.state == AWAIT_REQUEST:
+                    self.request()
+                elif self.state == RELAY:
+                    self.forward(sock)
+                elif self.state == LINGERING:
+                    self.recv(sock)
+        except Exception as err:
+            # A malformed message must not take down the whole loop
+            error("Connection failed", err)
+            self.close()
+        self.update()
+
+    def update(self):
+        """ Register the events each socket is waiting for """
+        if self.state == CLOSED:
+            return
+        if self.state == CLOSING and not any(map(self.backlog, self.pending)):
+            self.linger()
+            if self.state == CLOSED:
+                return
+        if self.state == RELAY and not self.shutdown():
+            return
+        for sock in self.pending:
+            events = 0
+            if self.backlog(sock):
+                events |= selectors.EVENT_WRITE
+            if self.state in (AWAIT_GREETING, AWAIT_REQUEST):
+                events |= selectors.EVENT_READ
+            elif self.state == LINGERING and sock is self.wrapper:
+                events |= selectors.EVENT_READ
+            elif self.state == CONNECTING and sock is self.socket_dst:
+                events |= selectors.EVENT_WRITE
+            elif (
+                    self.state == RELAY and sock not in self.eof and
+                    not self.backlog(self.peer(sock))
+            ):
+                # Stop reading while the other side is still backed up
+                events |= selectors.EVENT_READ
+            try:
+                key = SELECTOR.get_key(sock)
+            except KeyError:
+                key = None
+            if not events:
+                if key:
+                    SELECTOR.unregister(sock)
+            elif not key:
+                SELECTOR.register(sock, events, self.handle)
+            elif key.events != events:
+                SELECTOR.modify(sock, events, self.handle)
+
+    def shutdown(self):
+        """
+            Pass an end of stream on to the other end once everything read
+            before it is written, like a half-closed TCP connection. Return
+            False once the tunnel is closed
+        """
+        for sock in self.eof:
+            peer = self.peer(sock)
+            if peer in self.shut or self.backlog(peer):
+                continue
+            try:
+                peer.shutdown(socket.SHUT_WR)
+            except socket.error as err:
+                # A peer which already reset just ends the tunnel
+                if err.errno not in (errno.ENOTCONN, errno.ECONNRESET):
+                    error("Shutdown failed", err)
+                self.close()
+                return False
+            self.shut.add(peer)
+        if len(self.shut) == 2:
+            # Both directions are finished
+            self.close()
+            return False
+        return True
+
+    def end_of_stream(self, sock):
+        """ Called when sock has nothing more to send """
+        if self.state == RELAY:
+            # Keep relaying in the other direction
+            self.eof.add(sock)
+        elif self.state == LINGERING:
+            self.close()
+        else:
+            self.state = CLOSING
+
+    def linger(self):
+        """
+            Once the final reply is written, shut down the client's side
+            and discard anything it still sends until it closes as well.
+            Closing with unread data would reset the connection, which can
+            destroy the reply before the client reads it
+        """
+        try:
+            self.wrapper.shutdown(socket.SHUT_WR)
+        except socket.error:
+            self.close()
+            return
+        self.state = LINGERING
+        self.set_timer()
+
+    def set_timer(self):
+        """ Call timeout unless the state changes within TIMEOUT_SOCKET """
+        heappush(TIMERS, (
+            monotonic() + TIMEOUT_SOCKET, next(TIMER_IDS), self, self.state
+        ))
+
+    def timeout(self):
+        """ Called when the connection stayed too long in one state """
+        if self.state == CONNECTING:
+            print("Failed to connect to DST - err: timed out", file=sys.stderr)
+            self.fail()
+        else:
+            self.close()
+        self.update()
+
+    def send(self, sock, data):
+        """ Write data to sock, queueing whatever it does not accept """
+        if not self.pending[sock]:
+            try:
+                data = data[sock.send(data):]
+            except BlockingIOError:
+                pass
+            except socket.error as err:
+                error("Send failed", err)
+                self.close()
+                return
+        self.pending[sock] += data
+
+    def flush(self, sock):
+        """ Write as much pending data as sock accepts """
+        buf = self.pending[sock]
+        try:
+            while buf:
+                sent = sock.send(buf)
+                del buf[:sent]
+            while self.in_pipe.get(sock):
+                sent = splice(
+                    self.pipes[sock][0], sock.fileno(), self.in_pipe[sock]
+                )
+                self.in_pipe[sock] -= sent
+        except BlockingIOError:
+            pass
+        except socket.error as err:
+            error("Send failed", err)
+            self.close()
+            return False
+        return True
+
+    def recv(self, sock, size=BUFSIZE):
+        """
+            Read up to size bytes from sock into the shared receive buffer,
+            entering CLOSING at end of stream. The returned view is only
+            valid until the next recv
+        """
+        try:
+            received = sock.recv_into(RECV_VIEW, size)
+        except BlockingIOError:
+            return b''
         except socket.error as err:
-            error("Loop failed", err)
+            error("Recv failed", err)
+            self.close()
+            return b''
+        if not received:
+            self.end_of_stream(sock)
+        return RECV_VIEW[:received]
+
+    def recv_message(self, length):
+        """
+            Read the client's next handshake message, never past its end so
+            that data sent right after it is left for the relay. length
+            returns the size of the message as far as the bytes read so far
+            tell. Return the message, or None until it is complete
+        """
+        message = self.message
+        while len(message) < length(message):
+            data = self.recv(self.wrapper, length(message) - len(message))
+            if not data:
+                return None
+            message += data
+        self.message = bytearray()
+        return bytes(message)
+
+    def subnegotiation(self):
+        """
+            The client connects to the server, and sends a version
+            identifier/method selection message
+            The server selects from one of the methods given in METHODS, and
+            sends a METHOD selection message
+        """
+        data = self.recv_message(subnegotiation_length)
+        if data is None:
+            return
+        method = subnegotiation_client(data)
+        # Server Method selection message
+        # +----+--------+
+        # |VER | METHOD |
+        # +----+--------+
+        # | 1  |   1    |
+        # +----+--------+
+        if method != M_NOAUTH:
+            # Tell the client, it closes the connection in turn
+            self.state = CLOSING
+            self.send(self.wrapper, _SUBNEG_FAIL)
+            return
+        self.state = AWAIT_REQUEST
+        self.send(self.wrapper, _SUBNEG_OK)
+
+    def request(self):
+        """
+            The SOCKS request information is sent by the client as soon as it
+            has established a connection to the SOCKS server, and completed
+            the authentication negotiations.  The server evaluates the
+            request, and returns a reply
+        """
+        global RESOLVING
+        data = self.recv_message(request_length)
+        if data is None:
             return
+        dst = request_client(data)
+        if not dst:
+            self.fail()
+            return
+        self.state = CONNECTING
+        self.set_timer()
+        family, dst_addr, dst_port = dst
+        if family:
+            self.connect(dst_addr, dst_port, family)
+            return
+        cached = DNS_CACHE.get(dst_addr)
+        if cached and cached[0] > monotonic():
+            self.connect(cached[1], dst_port)
+            return
+        if RESOLVING >= DNS_WORKERS + DNS_BACKLOG:
+            print("DNS backlog full, rejecting", dst_addr, file=sys.stderr)
+            self.fail()
+            return
+        RESOLVING += 1
+        future = RESOLVER.submit(
+            socket.getaddrinfo,
+            dst_addr, dst_port, socket.AF_INET, socket.SOCK_STREAM,
+        )
+        future.add_done_callback(
+            lambda future: (RESOLVED.append((self, dst_addr, future)), wakeup())
+        )
+
+    def resolved(self, name, future):
+        """ Called by the event loop once the destination is resolved """
+        try:
+            dst_addr, dst_port = future.result()[0][4]
+        except Exception as err:
+            if self.state == CONNECTING:
+                error("Failed to resolve DST", err)
+                self.fail()
+            return
+        # Move name to the end, the oldest entries are evicted first
+        DNS_CACHE.pop(name, None)
+        DNS_CACHE[name] = (monotonic() + DNS_CACHE_TTL, dst_addr)
+        if len(DNS_CACHE) > DNS_CACHE_SIZE:
+            del DNS_CACHE[next(iter(DNS_CACHE))]
+        if self.state == CONNECTING:
+            self.connect(dst_addr, dst_port)
+
+    def connect(self, dst_addr, dst_port, family=socket.AF_INET):
+        """ Start connecting to the destination """
+        socket_dst = connect_to_dst(dst_addr, dst_port, family)
+        if socket_dst == 0:
+            self.fail()
+            return
+        self.socket_dst = socket_dst
+        self.pending[socket_dst] = bytearray()
+
+    def connected(self):
+        """ Called once the non-blocking connect has completed """
+        err = self.socket_dst.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+        if err:
+            print(f"Failed to connect to DST - err: {os.strerror(err)}",
+                  file=sys.stderr)
+            self.fail()
+            return
+        set_nodelay(self.socket_dst)
+        self.reply()
+
+    def fail(self):
+        """ Reply with a general failure and close """
+        self.state = CLOSING
+        self.send(self.wrapper, _REPLY_FAIL)
 
+    def reply(self):
+        """ Send the successful reply to the SOCKS request """
+        # Server Reply
+        # +----+-----+-------+------+----------+----------+
+        # |VER | REP |  RSV  | ATYP | BND.ADDR | BND.PORT |
+        # +----+-----+-------+------+----------+----------+
+        # | 1  |  1  | X'00' |  1   | Variable |    2     |
+        # +----+-----+-------+------+----------+----------+
+        # o  VER    protocol version: X'05'
+        # o  REP    Reply field:
+        #     o  X'00' succeeded
+        #     o  X'01' general SOCKS server failure
+        #     o  X'02' connection not allowed by ruleset
+        #     o  X'03' Network unreachable
+        #     o  X'04' Host unreachable
+        #     o  X'05' Connection refused
+        #     o  X'06' TTL expired
+        #     o  X'07' Command not supported
+        #     o  X'08' Address type not supported
+        #     o  X'09' to X'FF' unassigned
+        # o  RSV    RESERVED
+        # o  ATYP   address type of following address
+        #     o  IP V4 address: X'01'
+        #        o  DOMAINNAME: X'03'
+        #        o  IP V6 address: X'04'
+        # o  BND.ADDR       server bound address
+        # o  BND.PORT       server bound port in network octet order
+        family = self.socket_dst.family
+        bnd_addr, bnd_port = self.socket_dst.getsockname()[:2]
+        if family == socket.AF_INET6:
+            reply = _REPLY_OK_IPV6
+        else:
+            reply = _REPLY_OK_IPV4
+        reply += socket.inet_pton(family, bnd_addr) + pack('!H', bnd_port)
+        self.state = RELAY
+        self.send(self.wrapper, reply)
 
-def connect_to_dst(dst_addr, dst_port):
-    """ Connect to desired destination """
-    sock = create_socket()
-    if OUTGOING_INTERFACE:
+    def open_pipe(self, sock):
+        """ Create the pipe to splice data into sock through """
         try:
-            sock.setsockopt(
-                socket.SOL_SOCKET,
-                socket.SO_BINDTODEVICE,
-                OUTGOING_INTERFACE.encode(),
-            )
-        except PermissionError as err:
-            print(f"Only root can set OUTGOING_INTERFACE parameter: {err}", file=sys.stderr)
-            EXIT.set_status(True)
+            self.pipes[sock] = os.pipe2(os.O_NONBLOCK)
+        except OSError as err:
+            # Out of fds, this tunnel relays with recv/send instead
+            print(f"Failed to create pipe - err: {err}", file=sys.stderr)
+            self.splicing = False
+            return
+        self.in_pipe[sock] = 0
+
+    def close_pipes(self):
+        """ Close the pipes and fall back to recv/send """
+        for fds in self.pipes.values():
+            for fd in fds:
+                os.close(fd)
+        self.splicing = False
+        self.pipes = {}
+        self.in_pipe = {}
+
+    def forward(self, sock):
+        """ Relay what is readable on sock to the other end """
+        peer = self.peer(sock)
+        if self.splicing and peer not in self.pipes:
+            self.open_pipe(peer)
+        if peer in self.pipes:
+            self.splice(sock, peer)
+        else:
+            data = self.recv(sock)
+            if data:
+                self.send(peer, data)
+        if self.state == RELAY:
+            quickack(sock)
+
+    def splice(self, sock, peer):
+        """ Relay from sock to peer through the pipe, inside the kernel """
+        try:
+            received = splice(sock.fileno(), self.pipes[peer][1], SPLICE_LEN)
+        except BlockingIOError:
+            return
+        except OSError as err:
+            if err.errno == errno.EINVAL and not any(self.in_pipe.values()):
+                # The kernel can't splice these sockets, use recv/send
+                self.close_pipes()
+                self.forward(sock)
+                return
+            error("Splice failed", err)
+            self.close()
+            return
+        if not received:
+            self.end_of_stream(sock)
+            return
+        self.in_pipe[peer] += received
+        self.flush(peer)
+
+    def close(self):
+        """ Close both ends of the tunnel """
+        if self.state == CLOSED:
+            return
+        self.state = CLOSED
+        for sock in self.pending:
+            try:
+                SELECTOR.unregister(sock)
+            except KeyError:
+                pass
+            sock.close()
+        self.close_pipes()
+        CONNECTIONS.discard(self)
+        # The fds just freed let accept go on
+        resume_accept()
+
+
+def connect_to_dst(dst_addr, dst_port, family=socket.AF_INET):
+    """ Start connecting to desired destination """
+    # Running out of fds fails this client only, not the whole loop
     try:
-        sock.connect((dst_addr, dst_port))
-        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
-        return sock
+        sock = socket.socket(family, socket.SOCK_STREAM)
     except socket.error as err:
-        error("Failed to connect to DST", err)
+        error("Failed to create socket", err)
+        return 0
+    try:
+        sock.setblocking(False)
+        set_buffers(sock)
+        if OUTGOING_INTERFACE:
+            try:
+                sock.setsockopt(
+                    socket.SOL_SOCKET,
+                    socket.SO_BINDTODEVICE,
+                    OUTGOING_INTERFACE.encode(),
+                )
+            except PermissionError as err:
+                print(f"Only root can set OUTGOING_INTERFACE parameter: {err}", file=sys.stderr)
+                EXIT.set()
+        err = sock.connect_ex((dst_addr, dst_port))
+    except socket.error:
+        # Not owned by the connection yet, its close would miss it
+        sock.close()
+        raise
+    if err not in (0, errno.EINPROGRESS, errno.EWOULDBLOCK):
+        print(f"Failed to connect to DST - err: {os.strerror(err)}",
+              file=sys.stderr)
+        sock.close()
         return 0
+    return sock
 
 
-def request_client(wrapper):
+def request_length(s5_request):
+    """ Size of the SOCKS request, as far as s5_request tells """
+    # VER, CMD, RSV, ATYP and the first byte of DST.ADDR
+    if len(s5_request) < 5:
+        return 5
+    if s5_request[3] == ATYP_IPV4[0]:
+        return 4 + 4 + 2
+    if s5_request[3] == ATYP_IPV6[0]:
+        return 4 + 16 + 2
+    if s5_request[3] == ATYP_DOMAINNAME[0]:
+        return 5 + s5_request[4] + 2
+    # Unknown address type, request_client rejects it
+    return len(s5_request)
+
+
+def request_client(s5_request):
     """ Client request details """
     # +----+-----+-------+------+----------+----------+
     # |VER | CMD |  RSV  | ATYP | DST.ADDR | DST.PORT |
     # +----+-----+-------+------+----------+----------+
     # | 1  |  1  | X'00' |  1   | Variable |    2     |
     # +----+-----+-------+------+----------+----------+
-    try:
-        s5_request = wrapper.recv(BUFSIZE)
-    except ConnectionResetError:
-        if wrapper != 0:
-            wrapper.close()
-        error()
-        return False
+    # The family is None for a domain name which still has to be resolved
+    ver, cmd, rsv, atyp = unpack_from('!BBBB', s5_request)
     # Check VER, CMD and RSV
-    if (
-            s5_request[0:1] != VER or
-            s5_request[1:2] != CMD_CONNECT or
-            s5_request[2:3] != b'\x00'
-    ):
+    if ver != VER[0] or cmd != CMD_CONNECT[0] or rsv != 0:
         return False
     # IPV4
-    if s5_request[3:4] == ATYP_IPV4:
-        dst_addr = socket.inet_ntoa(s5_request[4:8])
-        dst_port = unpack('>H', s5_request[8:10])[0]
+    if atyp == ATYP_IPV4[0]:
+        dst_addr, dst_port = unpack_from('!4sH', s5_request, 4)
+        family = socket.AF_INET
+        dst_addr = socket.inet_ntop(socket.AF_INET, dst_addr)
     # DOMAIN NAME
-    elif s5_request[3:4] == ATYP_DOMAINNAME:
+    elif atyp == ATYP_DOMAINNAME[0]:
         sz_domain_name = s5_request[4]
-        # dst_addr = s5_request[5: 5 + sz_domain_name - len(s5_request)]
-        dst_addr = s5_request[5: 5 + sz_domain_name]
-        # port_to_unpack = s5_request[5 + sz_domain_name:len(s5_request)]
-        port_to_unpack = s5_request[5 + sz_domain_name: 5 + sz_domain_name + 2]
-        dst_port = unpack('>H', port_to_unpack)[0]
+        family = None
+        try:
+            dst_addr = s5_request[5: 5 + sz_domain_name].decode('idna')
+        except UnicodeError:
+            return False
+        dst_port, = unpack_from('!H', s5_request, 5 + sz_domain_name)
+    # IPV6
+    elif atyp == ATYP_IPV6[0]:
+        dst_addr, dst_port = unpack_from('!16sH', s5_request, 4)
+        family = socket.AF_INET6
+        dst_addr = socket.inet_ntop(socket.AF_INET6, dst_addr)
     else:
         return False
     print(dst_addr, dst_port)
-    return (dst_addr, dst_port)
+    return (family, dst_addr, dst_port)
 
 
-def request(wrapper):
-    """
-        The SOCKS request information is sent by the client as soon as it has
-        established a connection to the SOCKS server, and completed the
-        authentication negotiations.  The server evaluates the request, and
-        returns a reply
-    """
-    dst = request_client(wrapper)
-    socket_dst = 0
-    # Server Reply
-    # +----+-----+-------+------+----------+----------+
-    # |VER | REP |  RSV  | ATYP | BND.ADDR | BND.PORT |
-    # +----+-----+-------+------+----------+----------+
-    # | 1  |  1  | X'00' |  1   | Variable |    2     |
-    # +----+-----+-------+------+----------+----------+
-    # o  VER    protocol version: X'05'
-    # o  REP    Reply field:
-    #     o  X'00' succeeded
-    #     o  X'01' general SOCKS server failure
-    #     o  X'02' connection not allowed by ruleset
-    #     o  X'03' Network unreachable
-    #     o  X'04' Host unreachable
-    #     o  X'05' Connection refused
-    #     o  X'06' TTL expired
-    #     o  X'07' Command not supported
-    #     o  X'08' Address type not supported
-    #     o  X'09' to X'FF' unassigned
-    # o  RSV    RESERVED
-    # o  ATYP   address type of following address
-    #     o  IP V4 address: X'01'
-    #        o  DOMAINNAME: X'03'
-    #        o  IP V6 address: X'04'
-    # o  BND.ADDR       server bound address
-    # o  BND.PORT       server bound port in network octet order
-
-    rep = b'\x07'
-    bnd = b'\x00' + b'\x00' + b'\x00' + b'\x00' + b'\x00' + b'\x00'
-    if dst:
-        socket_dst = connect_to_dst(dst[0], dst[1])
-    if not dst or socket_dst == 0:
-        rep = b'\x01'
-    else:
-        rep = b'\x00'
-        bnd = socket.inet_aton(socket_dst.getsockname()[0])
-        bnd += pack(">H", socket_dst.getsockname()[1])
-    reply = VER + rep + b'\x00' + ATYP_IPV4 + bnd
-    try:
-        wrapper.sendall(reply)
-    except socket.error:
-        if wrapper != 0:
-            wrapper.close()
-        return
-    # start proxy
-    if rep == b'\x00':
-        proxy_loop(wrapper, socket_dst)
-    sleep(1)
-    if wrapper != 0:
-        wrapper.close()
-    if socket_dst != 0:
-        socket_dst.close()
-
-
-def subnegotiation_client(wrapper):
+def subnegotiation_length(identification_packet):
+    """ Size of the method selection message, as far as it tells """
+    if len(identification_packet) < 2:
+        return 2
+    return 2 + identification_packet[1]
+
+
+def subnegotiation_client(identification_packet):
     """
         The client connects to the server, and sends a version
         identifier/method selection message
@@ -242,60 +743,102 @@ def subnegotiation_client(wrapper):
     # +----+----------+----------+
     # | 1  |    1     | 1 to 255 |
     # +----+----------+----------+
-    try:
-        identification_packet = wrapper.recv(BUFSIZE)
-    except socket.error:
-        error()
-        return M_NOTAVAILABLE
     # VER field
-    if VER != identification_packet[0:1]:
+    if identification_packet[0] != VER[0]:
         return M_NOTAVAILABLE
-    # METHODS fields
-    nmethods = identification_packet[1]
+    # METHODS fields, recv_message read exactly NMETHODS of them
     methods = identification_packet[2:]
-    if len(methods) != nmethods:
-        return M_NOTAVAILABLE
-    for method in methods:
-        if method == ord(M_NOAUTH):
-            return M_NOAUTH
-    return M_NOTAVAILABLE
+    return M_NOAUTH if M_NOAUTH[0] in methods else M_NOTAVAILABLE
 
 
-def subnegotiation(wrapper):
+def accept(new_socket, mask):
     """
-        The client connects to the server, and sends a version
-        identifier/method selection message
-        The server selects from one of the methods given in METHODS, and
-        sends a METHOD selection message
+        Accept new clients and hand them to the event loop. A burst of
+        clients is taken in one go, up to ACCEPT_BATCH, rather than with one
+        select per client
     """
-    method = subnegotiation_client(wrapper)
-    # Server Method selection message
-    # +----+--------+
-    # |VER | METHOD |
-    # +----+--------+
-    # | 1  |   1    |
-    # +----+--------+
-    if method != M_NOAUTH:
-        return False
-    reply = VER + method
+    for _ in range(ACCEPT_BATCH):
+        try:
+            wrapper, _ = new_socket.accept()
+        except BlockingIOError:
+            return
+        except socket.error as err:
+            if err.errno in (errno.EMFILE, errno.ENFILE):
+                # The client stays queued and the socket readable, stop
+                # listening rather than spin until an fd is free
+                print(f"Accept paused - err: {err}", file=sys.stderr)
+                SELECTOR.unregister(new_socket)
+                PAUSED.append((monotonic() + ACCEPT_BACKOFF, new_socket))
+                return
+            error("Accept socket error", err)
+            return
+        if len(CONNECTIONS) >= MAX_CONNECTIONS:
+            # Refuse right away rather than leave the client waiting in the
+            # kernel accept queue
+            wrapper.close()
+            continue
+        try:
+            Connection(wrapper)
+        except socket.error as err:
+            # setsockopt fails with EINVAL on iOS once the client has reset
+            error("Failed to set up client socket", err)
+            wrapper.close()
+
+
+def resume_accept():
+    """ Listen again after accept ran out of fds """
+    while PAUSED:
+        _, new_socket = PAUSED.pop()
+        SELECTOR.register(new_socket, selectors.EVENT_READ, accept)
+
+
+def on_wakeup(fd, mask):
+    """ Drain the wakeup fd and finish pending name resolutions """
+    global RESOLVING
     try:
-        wrapper.sendall(reply)
-    except socket.error:
-        error()
-        return False
-    return True
+        while os.read(fd, 4096):
+            pass
+    except BlockingIOError:
+        pass
+    while RESOLVED:
+        conn, name, future = RESOLVED.popleft()
+        RESOLVING -= 1
+        try:
+            conn.resolved(name, future)
+        except Exception as err:
+            # As in Connection.handle, one client must not stop the loop
+            error("Connection failed", err)
+            conn.close()
+        conn.update()
+
+
+def next_timeout():
+    """ Seconds until the earliest deadline, or None """
+    while TIMERS and TIMERS[0][2].state != TIMERS[0][3]:
+        heappop(TIMERS)
+    deadlines = [deadline for deadline, _ in PAUSED]
+    if TIMERS:
+        deadlines.append(TIMERS[0][0])
+    if not deadlines:
+        return None
+    return max(0, min(deadlines) - monotonic())
 
 
-def connection(wrapper):
-    """ Function run by a thread """
-    if subnegotiation(wrapper):
-        request(wrapper)
+def expire_timers():
+    """ Time out connections whose deadline passed """
+    now = monotonic()
+    while TIMERS and TIMERS[0][0] <= now:
+        _, _, conn, state = heappop(TIMERS)
+        if conn.state == state:
+            conn.timeout()
+    if PAUSED and PAUSED[0][0] <= now:
+        resume_accept()
 
 
-def create_socket():
-    """ Create an INET, STREAMing socket """
+def create_socket(family=socket.AF_INET):
+    """ Create an INET (or INET6), STREAMing socket """
     try:
-        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock = socket.socket(family, socket.SOCK_STREAM)
         sock.settimeout(TIMEOUT_SOCKET)
     except socket.error as err:
         error("Failed to create socket", err)
@@ -311,7 +854,14 @@ def bind_port(sock):
     try:
         print('Bind {}'.format(str(LOCAL_PORT)))
         sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        # Only the workers share the port, a second instance must still
+        # fail to bind
+        if WORKERS > 1 and hasattr(socket, 'SO_REUSEPORT'):
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
         sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        # Accepted sockets inherit the buffer sizes, set before listen so
+        # the window scale offered to clients matches
+        set_buffers(sock)
         sock.bind((LOCAL_ADDR, LOCAL_PORT))
     except socket.error as err:
         error("Bind failed", err)
@@ -319,7 +869,7 @@ def bind_port(sock):
         sys.exit(0)
     # Listen
     try:
-        sock.listen(10)
+        sock.listen(socket.SOMAXCONN)
     except socket.error as err:
         error("Listen failed", err)
         sock.close()
@@ -327,85 +877,105 @@ def bind_port(sock):
     return sock
 
 
+def fork_workers():
+    """
+        Fork the WORKERS - 1 additional processes. Return their pids in the
+        parent and None in a child
+    """
+    pids = []
+    if not hasattr(os, 'fork') or not hasattr(socket, 'SO_REUSEPORT'):
+        return pids
+    for _ in range(WORKERS - 1):
+        pid = os.fork()
+        if not pid:
+            return None
+        pids.append(pid)
+    return pids
+
+
 def exit_handler(signum, frame):
     """ Signal handler called with signal, exit script """
     print('Signal handler called with signal', signum)
-    EXIT.set_status(True)
+    EXIT.set()
+    wakeup()
 
 
-def create_wpad_server(hhost, hport, phost, pport):
-    from http.server import BaseHTTPRequestHandler, HTTPServer
-    import base64
+_GFW_HOST_RE = re.compile(r'https://([^/]+)/')
+
+_DEFAULT_PAC = b"""
+function FindProxyForURL(url, host)
+{
+   if (isInNet(host, "192.168.0.0", "255.255.0.0")) {
+      return "DIRECT";
+   }
+   if (isInNet(host, "172.16.0.0", "255.240.0.0")) {
+      return "DIRECT";
+   }
+   if (isInNet(host, "10.0.0.0", "255.0.0.0")) {
+      return "DIRECT";
+   }
+   return proxy;
+}
+"""
 
 
+def create_wpad_server(hhost, hport, phost, pport):
     rules = None
 
     try:
-        import http.client
-        import re
-
-        m = re.match('https://(.*?)/', URL_GFW_LIST)
-        host = m.groups()[0]
-        conn = http.client.HTTPSConnection(host)
+        host = _GFW_HOST_RE.match(URL_GFW_LIST).group(1)
+        # Don't let a stalled download hold up startup
+        conn = http.client.HTTPSConnection(host, timeout=10)
         conn.request("GET", URL_GFW_LIST)
         res = conn.getresponse()
         data = res.read()
 
-        text = base64.b64decode(data).decode()
-        arr = text.split('\n')
-        arr.append(f"@@||{phost}")
-        it = filter(lambda x: x, arr) # filter empty lines
-        next(it) # ignore the first line
-        text = '",\n"'.join(it)
-        rules = f'var rules = [\n"{text}"\n];\n'
+        # The list is only passed through to clients, so keep it as bytes
+        arr = base64.b64decode(data).split(b'\n')
+        arr.append(f"@@||{phost}".encode())
+        # skip empty lines, comments and the [AutoProxy x.y.z] header
+        text = b'",\n"'.join(
+            line for line in arr
+            if line and not line.startswith((b'!', b'['))
+        )
+        rules = b'var rules = [\n"' + text + b'"\n];\n'
     except Exception as e:
         print('get gfwlist error:', e, file=sys.stderr)
         pass
 
+    # Everything served is fixed once the server starts, so encode it once
+    pac = None
+    try:
+        with open('proxy.pac', 'rb') as f:
+            pac = f.read()
+            # pac = re.sub('SOCKS5.*?DIRECT', f'SOCKS5 {phost}:{pport}; SOCKS {phost}:{pport}; DIRECT', pac)
+    except Exception as e:
+        print('open proxy.pac error:', e, file=sys.stderr)
+        pass
+
+    body = (
+        f'var proxy = "SOCKS5 {phost}:{pport}; SOCKS {phost}:{pport}; DIRECT;";\n'.encode() +
+        (rules or b'') +
+        (pac or _DEFAULT_PAC)
+    )
+
     class HTTPHandler(BaseHTTPRequestHandler):
+        # Content-Length is always sent, so connections can be kept alive;
+        # the threading server keeps one idle client from blocking others
+        protocol_version = "HTTP/1.1"
+
         def do_HEAD(s):
             s.send_response(200)
             s.send_header("Content-type", "application/x-ns-proxy-autoconfig")
+            s.send_header("Content-Length", str(len(body)))
             s.end_headers()
 
         def do_GET(s):
-            pac = None
-            try:
-                with open('proxy.pac') as f:
-                    import re
-                    pac = f.read()
-                    # pac = re.sub('SOCKS5.*?DIRECT', f'SOCKS5 {phost}:{pport}; SOCKS {phost}:{pport}; DIRECT', pac)
-            except Exception as e:
-                print('open proxy.pac error:', e, file=sys.stderr)
-                pass
-            s.send_response(200)
-            s.send_header("Content-type", "application/x-ns-proxy-autoconfig")
-            s.end_headers()
+            s.do_HEAD()
+            s.wfile.write(body)
 
-            s.wfile.write(f'var proxy = "SOCKS5 {phost}:{pport}; SOCKS {phost}:{pport}; DIRECT;";\n'.encode())
-            if rules:
-                s.wfile.write(rules.encode())
-            if pac:
-                s.wfile.write(pac.encode())
-            else:
-                s.wfile.write("""
-function FindProxyForURL(url, host)
-{
-   if (isInNet(host, "192.168.0.0", "255.255.0.0")) {
-      return "DIRECT";
-   }
-   if (isInNet(host, "172.16.0.0", "255.240.0.0")) {
-      return "DIRECT";
-   }
-   if (isInNet(host, "10.0.0.0", "255.0.0.0")) {
-      return "DIRECT";
-   }
-   return proxy;
-}
-""".encode())
-
-    HTTPServer.allow_reuse_address = True
-    server = HTTPServer((hhost, hport), HTTPHandler)
+    ThreadingHTTPServer.allow_reuse_address = True
+    server = ThreadingHTTPServer((hhost, hport), HTTPHandler)
     return server
 
 
@@ -418,6 +988,7 @@ def run_wpad_server(server):
 
 
 def main():
+    global SELECTOR, WAKEUP_R, WAKEUP_W
     PROXY_HOST = "172.20.10.1"
     SOCKS_HOST = "0.0.0.0"
     WPAD_PORT = 8080
@@ -428,36 +999,69 @@ def main():
     print("PAC URL: http://{}:{}/proxy.pac".format(PROXY_HOST, WPAD_PORT))
     print("SOCKS Address: {}:{}".format(PROXY_HOST or SOCKS_HOST, LOCAL_PORT))
 
-    thread = Thread(target=run_wpad_server, args=(wpad_server,))
-    thread.daemon = True
-    thread.start()
+    workers = fork_workers()
+    if workers is not None:
+        thread = Thread(target=run_wpad_server, args=(wpad_server,))
+        thread.daemon = True
+        thread.start()
 
 
     """ Main function """
+    # epoll on Linux, whatever the platform does best elsewhere (kqueue on
+    # iOS). Created after forking, each worker needs its own
+    SELECTOR = getattr(selectors, 'EpollSelector', selectors.DefaultSelector)()
+    if hasattr(os, 'eventfd'):
+        WAKEUP_R = WAKEUP_W = os.eventfd(0, os.EFD_NONBLOCK)
+    else:
+        WAKEUP_R, WAKEUP_W = os.pipe()
+        os.set_blocking(WAKEUP_R, False)
+        os.set_blocking(WAKEUP_W, False)
     new_socket = create_socket()
     bind_port(new_socket)
+    new_socket.setblocking(False)
     signal(SIGINT, exit_handler)
     signal(SIGTERM, exit_handler)
-    while not EXIT.get_status():
-        if activeCount() > MAX_THREADS:
-            sleep(3)
-            continue
-        try:
-            wrapper, _ = new_socket.accept()
-            wrapper.setblocking(1)
-        except socket.timeout:
-            continue
-        except socket.error as err:
-            error("Accept socket error", err)
-            continue
-        except TypeError as err:
-            error("Accept TypeError", err)
-            sys.exit(0)
-        recv_thread = Thread(target=connection, args=(wrapper, ))
-        recv_thread.start()
-    new_socket.close()
+    SELECTOR.register(WAKEUP_R, selectors.EVENT_READ, on_wakeup)
+    SELECTOR.register(new_socket, selectors.EVENT_READ, accept)
+    try:
+        while not EXIT.is_set():
+            for key, mask in SELECTOR.select(next_timeout()):
+                key.data(key.fileobj, mask)
+            expire_timers()
+    finally:
+        RESOLVER.shutdown(wait=False, cancel_futures=True)
+        for conn in list(CONNECTIONS):
+            conn.close()
+        SELECTOR.close()
+        new_socket.close()
+        for fd in {WAKEUP_R, WAKEUP_W}:
+            os.close(fd)
+        for pid in workers or ():
+            os.kill(pid, SIGTERM)
 
 
-EXIT = ExitStatus()
+EXIT = Event()
+# Event loop selector and its wakeup eventfd or self-pipe, created by main
+SELECTOR = None
+WAKEUP_R = WAKEUP_W = None
+RESOLVER = ThreadPoolExecutor(
+    max_workers=DNS_WORKERS, thread_name_prefix='socks-dns'
+)
+# Number of submitted resolutions not yet handed back to the loop
+RESOLVING = 0
+# Name resolutions finished by RESOLVER, waiting for the event loop
+RESOLVED = deque()
+# Domain name -> (expiry time, address)
+DNS_CACHE = {}
+# Deadlines as (deadline, id, connection, state), only valid while the
+# connection is still in that state
+TIMERS = []
+TIMER_IDS = count()
+CONNECTIONS = set()
+# The listening socket as (resume time, socket) while accept is out of fds
+PAUSED = []
+# Receive buffer shared by all connections, the loop reads one at a time
+RECV_BUFFER = bytearray(BUFSIZE)
+RECV_VIEW = memoryview(RECV_BUFFER)
 if __name__ == '__main__':
     main()
@@ -2,11 +2,16 @@
 # Original from https://github.com/rushter/socks5/blob/master/server.py
 # Modified for Pythonista by @nneonneo
 
+import base64
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import http.client
 from io import BytesIO
 import logging
+import re
 from select import select
 import socket
 import struct
+import sys
 import threading
 from socketserver import ThreadingMixIn, TCPServer, StreamRequestHandler
 
@@ -18,6 +23,7 @@ CONNECT_HOST = None
 IDLE_TIMEOUT = 1800
 
 URL_GFW_LIST = "https://cdn.jsdelivr.net/gh/gfwlist/gfwlist/gfwlist.txt"
+_GFW_HOST_RE = re.compile(r'https://([^/]+)/')
 
 # Try to keep the screen from turning off (iOS)
 try:
@@ -365,79 +371,80 @@ class SocksProxy(StreamRequestHandler):
         self.server.close_request(self.request)
 
 
-def create_wpad_server(hhost, hport, phost, pport):
-    from http.server import BaseHTTPRequestHandler, HTTPServer
-    import base64
+_DEFAULT_PAC = b"""
+function FindProxyForURL(url, host)
+{
+   if (isInNet(host, "192.168.0.0", "255.255.0.0")) {
+      return "DIRECT";
+   }
+   if (isInNet(host, "172.16.0.0", "255.240.0.0")) {
+      return "DIRECT";
+   }
+   if (isInNet(host, "10.0.0.0", "255.0.0.0")) {
+      return "DIRECT";
+   }
+   return proxy;
+}
+"""
 
 
+def create_wpad_server(hhost, hport, phost, pport):
     rules = None
 
     try:
-        import http.client
-        import re
-
-        m = re.match('https://(.*?)/', URL_GFW_LIST)
-        host = m.groups()[0]
-        conn = http.client.HTTPSConnection(host)
+        host = _GFW_HOST_RE.match(URL_GFW_LIST).group(1)
+        # Don't let a stalled download hold up startup
+        conn = http.client.HTTPSConnection(host, timeout=10)
         conn.request("GET", URL_GFW_LIST)
         res = conn.getresponse()
         data = res.read()
 
-        text = base64.b64decode(data).decode()
-        arr = text.split('\n')
-        arr.append(f"@@||{phost}")
-        it = filter(lambda x: x, arr) # filter empty lines
-        next(it) # ignore the first line
-        text = '",\n"'.join(it)
-        rules = f'var rules = [\n"{text}"\n];\n'
+        # The list is only passed through to clients, so keep it as bytes
+        arr = base64.b64decode(data).split(b'\n')
+        arr.append(f"@@||{phost}".encode())
+        # skip empty lines, comments and the [AutoProxy x.y.z] header
+        text = b'",\n"'.join(
+            line for line in arr
+            if line and not line.startswith((b'!', b'['))
+        )
+        rules = b'var rules = [\n"' + text + b'"\n];\n'
     except Exception as e:
         print('get gfwlist error:', e, file=sys.stderr)
         pass
 
+    # Everything served is fixed once the server starts, so encode it once
+    pac = None
+    try:
+        with open('proxy.pac', 'rb') as f:
+            pac = f.read()
+            # pac = re.sub('SOCKS5.*?DIRECT', f'SOCKS5 {phost}:{pport}; SOCKS {phost}:{pport}; DIRECT', pac)
+    except Exception as e:
+        print('open proxy.pac error:', e, file=sys.stderr)
+        pass
+
+    body = (
+        f'var proxy = "SOCKS5 {phost}:{pport}; SOCKS {phost}:{pport}; DIRECT;";\n'.encode() +
+        (rules or b'') +
+        (pac or _DEFAULT_PAC)
+    )
+
     class HTTPHandler(BaseHTTPRequestHandler):
+        # Content-Length is always sent, so connections can be kept alive;
+        # the threading server keeps one idle client from blocking others
+        protocol_version = "HTTP/1.1"
+
         def do_HEAD(s):
             s.send_response(200)
             s.send_header("Content-type", "application/x-ns-proxy-autoconfig")
+            s.send_header("Content-Length", str(len(body)))
             s.end_headers()
 
         def do_GET(s):
-            pac = None
-            try:
-                with open('proxy.pac') as f:
-                    import re
-                    pac = f.read()
-                    # pac = re.sub('SOCKS5.*?DIRECT', f'SOCKS5 {phost}:{pport}; SOCKS {phost}:{pport}; DIRECT', pac)
-            except Exception as e:
-                print('open proxy.pac error:', e, file=sys.stderr)
-                pass
-            s.send_response(200)
-            s.send_header("Content-type", "application/x-ns-proxy-autoconfig")
-            s.end_headers()
-
-            s.wfile.write(f'var proxy = "SOCKS5 {phost}:{pport}; SOCKS {phost}:{pport}; DIRECT;";\n'.encode())
-            if rules:
-                s.wfile.write(rules.encode())
-            if pac:
-                s.wfile.write(pac.encode())
-            else:
-                s.wfile.write("""
-function FindProxyForURL(url, host)
-{
-   if (isInNet(host, "192.168.0.0", "255.255.0.0")) {
-      return "DIRECT";
-   }
-   if (isInNet(host, "172.16.0.0", "255.240.0.0")) {
-      return "DIRECT";
-   }
-   if (isInNet(host, "10.0.0.0", "255.0.0.0")) {
-      return "DIRECT";
-   }
-   return proxy;
-}
-""".encode())
+            s.do_HEAD()
+            s.wfile.write(body)
 
-    HTTPServer.allow_reuse_address = True
-    server = HTTPServer((hhost, hport), HTTPHandler)
+    ThreadingHTTPServer.allow_reuse_address = True
+    server = ThreadingHTTPServer((hhost, hport), HTTPHandler)
     return server
 
 